@@ -1,19 +1,32 @@
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
-import tempfile
+import os
 import time
 import wave
-from collections import deque
+from collections import OrderedDict, deque
 from concurrent import futures
-from threading import Event
+from pathlib import Path
+from threading import BoundedSemaphore, Event, Lock, Thread
+from typing import Callable
 
+import numpy as np
+import onnxruntime
 import simpleaudio as sa
-import soundfile as sf
-from nltk.tokenize import sent_tokenize
 from piper import PiperVoice
+from piper.config import PiperConfig
 from simpleaudio import WaveObject
 from tqdm.auto import tqdm
 
-from text_cleaning import combined_text_cleaning
+from text_cleaning import (
+    combine_short_sentences,
+    combined_text_cleaning,
+    group_sentences,
+    make_sentences,
+)
 
 logging.getLogger("phonemizer").setLevel(logging.ERROR)
 
@@ -21,60 +34,273 @@ FAILED_TO_COPY_TEXT = "Sorry, I failed to copy that text"
 
 STATIC_CACHE_STRING = [FAILED_TO_COPY_TEXT]
 
+WARM_UP_TEXT = "Ready."
+
+CACHE_DIR = Path.home() / ".cache" / "smartts"
+
+DEFAULT_MAX_DISK_CACHE_BYTES = 500 * 1024 * 1024
+
+DEFAULT_MAX_MEMORY_CACHE_BYTES = 64 * 1024 * 1024
+
+# Age after which an unfinished cache write is assumed abandoned, in seconds
+STALE_TEMP_FILE_AGE = 60 * 60
+
+# Audio format used for playback and the disk cache
+NUM_CHANNELS = 1  # mono
+SAMPLE_WIDTH = 2  # 16-bit
+
+DEFAULT_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+# Upper bound on engine calls running at once across all readers, to cap
+# the memory held by in-flight ONNX inference
+MAX_CONCURRENT_SYNTHESIS = 3
+synthesis_slots = BoundedSemaphore(MAX_CONCURRENT_SYNTHESIS)
+
+# Chunks synthesized ahead of playback beyond one per worker
+AUDIO_LOOKAHEAD = 2
+
+# How often playback checks for a stop request, in seconds
+PLAYBACK_POLL_INTERVAL = 0.01
+
 
 class AudioCache:
-    def __init__(self, max_size: int):
-        self.cache = deque(maxlen=max_size)
-        self.static_cache = []
+    """
+    Two-tier audio cache: an in-memory LRU of recent WaveObjects in front of a
+    persistent directory of WAV files named by a hash of the synthesis
+    parameters. The in-memory tier holds at most max_size entries and
+    max_memory_bytes of audio; the directory is trimmed, oldest first, to
+    max_disk_bytes.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        cache_dir: Path = CACHE_DIR,
+        max_disk_bytes: int = DEFAULT_MAX_DISK_CACHE_BYTES,
+        max_memory_bytes: int = DEFAULT_MAX_MEMORY_CACHE_BYTES,
+    ):
+        self.max_size = max_size
+        self.max_memory_bytes = max_memory_bytes
+        self.memory_bytes = 0
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.cache: OrderedDict[tuple[str, float], WaveObject] = OrderedDict()
+        self.static_cache: dict[tuple[str, float], WaveObject] = {}
+        self._lock = Lock()
+        self._trim_lock = Lock()
+
+    @staticmethod
+    def _key(text: str, speed_factor: float) -> tuple[str, float]:
+        return text, round(speed_factor, 3)
 
     def get(self, text: str, speed_factor: float):
-        for cache_type in [self.cache, self.static_cache]:
-            for cached_text, cached_speed, audio_file_path in cache_type:
-                if cached_text == text and cached_speed == speed_factor:
-                    logging.info(f"Cache hit for {text}")
-                    return audio_file_path
-        return None
+        key = self._key(text, speed_factor)
+        with self._lock:
+            wave_obj = self.static_cache.get(key)
+            if wave_obj is None:
+                wave_obj = self.cache.get(key)
+                if wave_obj is not None:
+                    self.cache.move_to_end(key)
+        if wave_obj is not None:
+            logging.info(f"Cache hit for {text}")
+        return wave_obj
+
+    def add(self, text: str, speed_factor: float, wave_obj: WaveObject, static=False):
+        key = self._key(text, speed_factor)
+        with self._lock:
+            if static:
+                logging.info("Adding text to static cache")
+                self.static_cache[key] = wave_obj
+            else:
+                logging.info("Adding text to cache")
+                previous = self.cache.pop(key, None)
+                if previous is not None:
+                    self.memory_bytes -= len(previous.audio_data)
+                self.cache[key] = wave_obj
+                self.memory_bytes += len(wave_obj.audio_data)
+                while len(self.cache) > 1 and (
+                    len(self.cache) > self.max_size
+                    or self.memory_bytes > self.max_memory_bytes
+                ):
+                    _, evicted = self.cache.popitem(last=False)
+                    self.memory_bytes -= len(evicted.audio_data)
+
+    def file_path(
+        self, text: str, speed_factor: float, speaker: str, tts_provider: str
+    ) -> Path:
+        """Stable on-disk location for the audio of the given synthesis parameters."""
+        _, speed_factor = self._key(text, speed_factor)
+        key = f"{tts_provider}|{speaker}|{speed_factor}|{text}"
+        return self.cache_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.wav"
+
+    def get_file(
+        self, text: str, speed_factor: float, speaker: str, tts_provider: str
+    ) -> str | None:
+        """Look up a previously synthesized file on disk and mark it recently used."""
+        audio_file_path = self.file_path(text, speed_factor, speaker, tts_provider)
+        try:
+            os.utime(audio_file_path)
+        except FileNotFoundError:
+            return None
+        logging.info(f"Disk cache hit for {text}")
+        return str(audio_file_path)
+
+    def trim_disk(self) -> None:
+        """
+        Delete the least recently used files until the cache fits max_disk_bytes,
+        along with temporary files from interrupted writes.
+        """
+        if not self._trim_lock.acquire(blocking=False):
+            return
+        try:
+            entries = []
+            total_bytes = 0
+            stale_before = time.time() - STALE_TEMP_FILE_AGE
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".tmp"):
+                        # Left behind by a write that was interrupted
+                        if entry.stat().st_mtime < stale_before:
+                            os.remove(entry.path)
+                        continue
+                    if not entry.name.endswith(".wav"):
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_bytes += stat.st_size
+
+            for _, size, path in sorted(entries):
+                if total_bytes <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+        except FileNotFoundError:
+            pass
+        finally:
+            self._trim_lock.release()
+
+
+audio_cache = AudioCache(max_size=256)
+
+# Persists fresh audio to the disk cache without holding up playback
+cache_writer = futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="audio-cache-writer"
+)
+
+
+def quantized_model_path(speaker: str) -> Path:
+    """Location of the int8 version of a piper model, next to the original."""
+    model_path = Path(speaker)
+    return model_path.with_suffix(".int8.onnx")
+
+
+def quantize_piper_voice(speaker: str) -> Path:
+    """
+    Write an int8 dynamically quantized copy of a piper model. This only needs
+    to be run once, with smartts.py --quantize-voice; load_piper_voice picks the
+    quantized model up on the next start.
+
+    Returns:
+        Path to the quantized model.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
 
-    def add(self, text: str, speed_factor: float, audio_file_path: str, static=False):
-        if static:
-            logging.info("Adding text to static cache")
-            self.static_cache.append((text, speed_factor, audio_file_path))
-        else:
-            logging.info("Adding text to cache")
-            self.cache.append((text, speed_factor, audio_file_path))
+    output_path = quantized_model_path(speaker)
+    quantize_dynamic(speaker, output_path, weight_type=QuantType.QInt8)
+    return output_path
 
 
-audio_cache = AudioCache(max_size=20)
+def piper_session_options() -> onnxruntime.SessionOptions:
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    return session_options
+
+
+def execution_providers(device: str) -> list[str]:
+    """ONNX Runtime execution providers for the requested device."""
+    if device == "cpu":
+        return ["CPUExecutionProvider"]
+    if device != "cuda":
+        raise ValueError("device must be either 'cpu' or 'cuda'")
+    if "CUDAExecutionProvider" not in onnxruntime.get_available_providers():
+        logging.warning("CUDA is not available, falling back to CPU")
+        return ["CPUExecutionProvider"]
+    return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+
+
+@functools.lru_cache(maxsize=None)
+def piper_model_path(speaker: str) -> Path:
+    """
+    The model file load_piper_voice uses for a speaker: the int8 version if it
+    exists, otherwise the original. Resolved once per process, so the disk cache
+    key always matches the model that was actually loaded.
+    """
+    model_path = quantized_model_path(speaker)
+    if model_path.exists():
+        return model_path
+    return Path(speaker)
+
+
+@functools.lru_cache(maxsize=4)
+def load_piper_voice(speaker: str, device: str = "cpu") -> PiperVoice:
+    model_path = piper_model_path(speaker)
+    logging.info(f"Loading piper voice {model_path}")
+
+    with open(f"{speaker}.json", "r", encoding="utf-8") as config_file:
+        config = PiperConfig.from_dict(json.load(config_file))
+
+    session = onnxruntime.InferenceSession(
+        str(model_path),
+        sess_options=piper_session_options(),
+        providers=execution_providers(device),
+    )
+    return PiperVoice(session=session, config=config)
+
+
+class AudioData:
+    """Mono 16-bit PCM audio and its sample rate."""
+
+    def __init__(self, pcm: bytes, sample_rate: int):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+
+    def to_wave_object(self) -> WaveObject:
+        return sa.WaveObject(
+            self.pcm,
+            num_channels=NUM_CHANNELS,
+            bytes_per_sample=SAMPLE_WIDTH,
+            sample_rate=self.sample_rate,
+        )
 
 
 def tts_piper(
     text: str,
     speaker: str,
-    audio_file_path: str,
     speed_factor: float = 1,
-) -> None:
-    with wave.open(audio_file_path, "wb") as wav_file:
-
-        voice = PiperVoice.load(speaker)
-        wav_file.setnchannels(1)  # mono
-        wav_file.setsampwidth(2)  # 16-bit
-        wav_file.setframerate(voice.config.sample_rate)
-
-        voice.synthesize(
-            text=text,
-            wav_file=wav_file,
+    engine: PiperVoice | None = None,
+) -> AudioData:
+    voice = engine if engine is not None else load_piper_voice(speaker)
+    pcm = b"".join(
+        voice.synthesize_stream_raw(
+            text,
             length_scale=1.0 / speed_factor,
             sentence_silence=0.3,
         )
+    )
+    return AudioData(pcm, voice.config.sample_rate)
 
 
 def tts_kokoro(
     text: str,
     speaker: str,
-    audio_file_path: str,
     speed_factor: float = 1,
     engine=None,
-) -> None:
+) -> AudioData:
     if engine is None:
         raise ValueError("Kokoro engine is not initialized")
     samples, sample_rate = engine.create(
@@ -83,7 +309,116 @@ def tts_kokoro(
         speed=speed_factor,
         lang="en-us",
     )
-    sf.write(audio_file_path, samples, sample_rate)
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+    return AudioData(pcm, sample_rate)
+
+
+TTS_PROVIDERS = {
+    "piper": tts_piper,
+    "kokoro": tts_kokoro,
+}
+
+# Providers that split multi-sentence text themselves, so adjacent
+# sentences can be synthesized in one call, with group_sentences limits
+BATCHED_PROVIDERS = {
+    "piper": {"max_chars": 200},
+    "kokoro": {"max_chars": 400, "max_words": 40},
+}
+
+
+_temp_file_ids = itertools.count()
+
+
+def write_wav_file(audio_file_path: Path, audio: AudioData) -> None:
+    """Atomically write audio to a WAV file so readers never see a partial file."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(NUM_CHANNELS)
+        wav_file.setsampwidth(SAMPLE_WIDTH)
+        wav_file.setframerate(audio.sample_rate)
+        wav_file.writeframes(audio.pcm)
+
+    audio_file_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = audio_file_path.with_name(
+        f"{audio_file_path.name}.{os.getpid()}.{next(_temp_file_ids)}.tmp"
+    )
+    try:
+        with open(temp_path, "xb") as temp_file:
+            temp_file.write(buffer.getbuffer())
+        os.replace(temp_path, audio_file_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def log_cache_write_error(cache_write: futures.Future) -> None:
+    """Report a failed disk cache write, since nothing else waits on its result."""
+    if not cache_write.cancelled() and cache_write.exception() is not None:
+        logging.error(
+            "Writing to the disk cache failed", exc_info=cache_write.exception()
+        )
+
+
+def synthesize(
+    text: str,
+    speed_factor: float,
+    speaker: str,
+    tts_provider: str,
+    engine,
+) -> WaveObject:
+    """
+    Synthesize text, reusing a previous result from the disk cache if there is one.
+
+    Fresh audio is played from memory and persisted to the disk cache in the
+    background.
+    """
+    # Audio from an fp32 and an int8 piper model must not share cache entries
+    model = str(piper_model_path(speaker)) if tts_provider == "piper" else speaker
+    cached_file = audio_cache.get_file(text, speed_factor, model, tts_provider)
+    if cached_file is not None:
+        return sa.WaveObject.from_wave_file(cached_file)
+
+    tts = TTS_PROVIDERS[tts_provider]
+    with synthesis_slots:
+        audio = tts(text, speaker, speed_factor, engine)
+    cache_write = cache_writer.submit(
+        write_wav_file,
+        audio_cache.file_path(text, speed_factor, model, tts_provider),
+        audio,
+    )
+    cache_write.add_done_callback(log_cache_write_error)
+    return audio.to_wave_object()
+
+
+def warm_up_engine(
+    speaker: str,
+    speed_factor: float,
+    tts_provider: str,
+    engine=None,
+) -> None:
+    """
+    Run one short synthesis so ONNX Runtime finishes its lazy initialization
+    before the first real request.
+    """
+    tts = TTS_PROVIDERS[tts_provider]
+    try:
+        tts(WARM_UP_TEXT, speaker, speed_factor, engine)
+    except Exception as e:
+        logging.warning(f"Warning: Engine warm-up failed - {str(e)}")
+
+
+def warm_static_cache(
+    speaker: str,
+    speed_factor: float,
+    tts_provider: str,
+    engine=None,
+) -> None:
+    """Pre-synthesize STATIC_CACHE_STRING so error messages play without delay."""
+    for text in STATIC_CACHE_STRING:
+        if audio_cache.get(text, speed_factor) is not None:
+            continue
+        wave_obj = synthesize(text, speed_factor, speaker, tts_provider, engine)
+        audio_cache.add(text, speed_factor, wave_obj, static=True)
 
 
 def create_audio_segment(
@@ -98,54 +433,45 @@ def create_audio_segment(
 
     if stop_event.is_set():
         return
-    cached_audio_path = audio_cache.get(text_chunk, speed_factor)
-    if cached_audio_path:
-        audio_file_path = cached_audio_path
-    else:
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=".wav", mode="wb"
-        ) as temp_file:
-            audio_file_path = temp_file.name
-
-            if tts_provider == "piper":
-                tts_piper(text_chunk, speaker, audio_file_path, speed_factor)
-            elif tts_provider == "kokoro":
-                tts_kokoro(text_chunk, speaker, audio_file_path, speed_factor, engine)
-
-            if text_chunk in STATIC_CACHE_STRING:
-                audio_cache.add(text_chunk, speed_factor, audio_file_path, static=True)
-            else:
-                audio_cache.add(text_chunk, speed_factor, audio_file_path)
+    wave_obj = audio_cache.get(text_chunk, speed_factor)
+    if wave_obj is None:
+        wave_obj = synthesize(text_chunk, speed_factor, speaker, tts_provider, engine)
+        audio_cache.add(
+            text_chunk,
+            speed_factor,
+            wave_obj,
+            static=text_chunk in STATIC_CACHE_STRING,
+        )
     if stop_event.is_set():
         return
 
-    wave_obj = sa.WaveObject.from_wave_file(audio_file_path)
     audio_generation_bar.update(1)
     audio_generation_bar.refresh()
     return wave_obj
 
 
-def make_sentences(text: str) -> list[str]:
-
-    text_chunks = sent_tokenize(text)
-    for rm in ["\r", "\t", ".", " "]:
-        if rm in text_chunks:
-            text_chunks.remove(rm)
-
-    text_chunks = [chunk.strip() for chunk in text_chunks]
-
-    return text_chunks
-
-
 def read_sentences(
     text_chunks: list[str],
-    indexed_futures: dict,
+    submit: Callable[[str], futures.Future],
     stop_event: Event,
     sentence_pause: float,
+    lookahead: int,
 ):
-    word_count = 0
-    for chunk in text_chunks:
-        word_count += len(chunk.split())
+    """
+    Play text chunks in order, keeping at most lookahead chunks submitted for
+    synthesis ahead of playback so finished audio does not pile up in memory.
+    The first chunk is synthesized on its own so playback starts as soon as
+    possible.
+
+    Args:
+        text_chunks: The text chunks to read, in order.
+        submit: Starts synthesis of a chunk and returns its future.
+        stop_event: An event to signal stopping the audio generation.
+        sentence_pause: Pause between chunks, in seconds.
+        lookahead: Maximum number of chunks submitted but not yet played.
+    """
+    chunk_word_counts = [len(chunk.split()) for chunk in text_chunks]
+    word_count = sum(chunk_word_counts)
 
     progress_bar = tqdm(
         total=word_count, desc="Playing audio", unit=" words", leave=False, position=1
@@ -153,37 +479,53 @@ def read_sentences(
 
     current_sentence = tqdm(total=0, bar_format="{desc}", position=2, leave=False)
 
-    for index in sorted(indexed_futures.keys()):
+    upcoming = iter(zip(text_chunks, chunk_word_counts))
+    pending_audio: deque[tuple[futures.Future, str, int]] = deque()
 
-        future, chunk_text = indexed_futures[index]
-        logging.info(chunk_text)
-        current_sentence.set_description_str(chunk_text)
-        current_sentence.refresh()
+    def submit_upcoming(limit: int) -> None:
+        for chunk, chunk_word_count in itertools.islice(
+            upcoming, limit - len(pending_audio)
+        ):
+            pending_audio.append((submit(chunk), chunk, chunk_word_count))
+
+    for index in range(len(text_chunks)):
 
         if stop_event.is_set():
+            # Drop synthesis work that has not started yet
+            for pending_future, _, _ in pending_audio:
+                pending_future.cancel()
             break
 
+        # The first chunk is synthesized alone so it has every core to itself
+        submit_upcoming(lookahead if index > 0 else 1)
+        future, chunk_text, chunk_word_count = pending_audio.popleft()
+
+        logging.info(chunk_text)
+        current_sentence.set_description_str(chunk_text)
+        current_sentence.refresh()
+
         audio_obj = future.result()
 
-        if audio_obj is None:
-            break
+        if index == 0 and not stop_event.is_set():
+            # Fill the lookahead window while the first chunk plays
+            submit_upcoming(lookahead - 1)
 
-        if stop_event.is_set():
-            break
+        if audio_obj is None:
+            continue
 
-        if index > 0:
-            time.sleep(sentence_pause)
+        if index > 0 and stop_event.wait(timeout=sentence_pause):
+            continue
 
         play_obj = audio_obj.play()
 
         while play_obj.is_playing():
-            if stop_event.is_set():
+            if stop_event.wait(timeout=PLAYBACK_POLL_INTERVAL):
                 play_obj.stop()
                 break
-        progress_bar.update(len(chunk_text.split()))
+        progress_bar.update(chunk_word_count)
 
     # Clean up progress bars
-    progress_bar.update(word_count - index)
+    progress_bar.update(word_count - progress_bar.n)
     progress_bar.refresh()
     progress_bar.close()
 
@@ -199,6 +541,7 @@ def async_audio_generation(
     tts_provider: str = "piper",
     engine=None,
     sentence_pause: float = 0.3,
+    max_workers: int = DEFAULT_MAX_WORKERS,
 ) -> None:
     """
     Asynchronously generates and plays audio from text.
@@ -207,6 +550,7 @@ def async_audio_generation(
         text: The text to be converted to speech.
         speed_factor: Speed factor for the audio.
         stop_event: An event to signal stopping the audio generation.
+        max_workers: Number of sentences synthesized concurrently.
     """
     # Remove unwanted characters
     logging.info(f"Input text: {text}")
@@ -214,6 +558,13 @@ def async_audio_generation(
     logging.info(f"Cleaned text: {text}")
 
     text_chunks = make_sentences(text)
+    text_chunks = combine_short_sentences(text_chunks, min_words=4)
+    if tts_provider in BATCHED_PROVIDERS:
+        # Keep the first sentence on its own so playback can start after
+        # synthesizing just that, and batch the rest
+        text_chunks = text_chunks[:1] + group_sentences(
+            text_chunks[1:], **BATCHED_PROVIDERS[tts_provider]
+        )
 
     logging.info(f"All input text: {text_chunks}")
 
@@ -225,26 +576,26 @@ def async_audio_generation(
         unit=" sentences",
     )
 
-    with futures.ThreadPoolExecutor(max_workers=1) as audio_gen_executor:
-        # Store futures with their index and associated text chunk
-        indexed_futures = {
-            index: (
-                audio_gen_executor.submit(
-                    create_audio_segment,
-                    stop_event,
-                    chunk,
-                    speed_factor,
-                    speaker,
-                    tts_provider,
-                    engine,
-                    audio_generation_bar,
-                ),
-                chunk,
-            )
-            for index, chunk in enumerate(text_chunks)
-        }
-
-        read_sentences(text_chunks, indexed_futures, stop_event, sentence_pause)
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as audio_gen_executor:
+        submit = functools.partial(
+            audio_gen_executor.submit,
+            create_audio_segment,
+            stop_event,
+            speed_factor=speed_factor,
+            speaker=speaker,
+            tts_provider=tts_provider,
+            engine=engine,
+            audio_generation_bar=audio_generation_bar,
+        )
+        read_sentences(
+            text_chunks,
+            submit,
+            stop_event,
+            sentence_pause,
+            lookahead=max_workers + AUDIO_LOOKAHEAD,
+        )
+
+    Thread(target=audio_cache.trim_disk, daemon=True).start()
 
     audio_generation_bar.update(len(text_chunks) - audio_generation_bar.n)
     audio_generation_bar.refresh()
@@ -1,19 +1,52 @@
 import argparse
+import functools
 import json
 import logging
+import os
+import queue
+import shutil
+import subprocess
+import sys
 import threading
 import time
+from concurrent import futures
 from pathlib import Path
 from threading import Event
-from typing import Union
+from typing import Any, Optional, Union
 
+import numpy as np
 import pyautogui
 import pyperclip
 from kokoro_onnx import Kokoro
 from pynput.keyboard import Key, KeyCode, Listener
 from tqdm.auto import tqdm
 
-from audio_helpers import FAILED_TO_COPY_TEXT, async_audio_generation
+try:
+    import orjson
+except ImportError:  # optional, only makes the JSON files faster to parse
+    orjson = None
+
+from audio_helpers import (
+    FAILED_TO_COPY_TEXT,
+    TTS_PROVIDERS,
+    async_audio_generation,
+    audio_cache,
+    load_piper_voice,
+    quantize_piper_voice,
+    warm_static_cache,
+    warm_up_engine,
+)
+
+# How long to wait for the copied selection to reach the clipboard, in seconds
+CLIPBOARD_TIMEOUT = 0.5
+CLIPBOARD_POLL_INTERVAL = 0.005
+PRIMARY_SELECTION_TIMEOUT = 0.2
+
+CONFIG_PATH = "config.json"
+KOKORO_MODEL_PATH = "kokoro-v0_19.onnx"
+KOKORO_VOICES_JSON_PATH = "voices.json"
+# Packed float32 arrays, much faster to load than the JSON voices file
+KOKORO_VOICES_NPZ_PATH = "voices.npz"
 
 
 def copy_selected_text() -> str:
@@ -25,54 +58,172 @@ def copy_selected_text() -> str:
     """
     # grab the current clipboard content
     current_clipboard = pyperclip.paste()
-    # clear the clipboard
     empty_clipboard = ""
-    pyperclip.copy(empty_clipboard)
-    time.sleep(0.03)
+    # clear the clipboard, unless it is empty already
+    if current_clipboard != empty_clipboard:
+        pyperclip.copy(empty_clipboard)
+        time.sleep(0.03)
     # copy the selected text to the clipboard
     pyautogui.hotkey("ctrl", "c", interval=0.05)
     # wait for the clipboard to be filled
-    for i in range(2):
-        clip_board = pyperclip.paste()
-        if clip_board != empty_clipboard:
-            # refill the clipboard with the original content
-            pyperclip.copy(current_clipboard)
-            return clip_board
-        time.sleep(0.1)
-    # refill the clipboard with the original content
-    pyperclip.copy(current_clipboard)
-    return FAILED_TO_COPY_TEXT
+    clip_board = FAILED_TO_COPY_TEXT
+    deadline = time.monotonic() + CLIPBOARD_TIMEOUT
+    while time.monotonic() < deadline:
+        text = pyperclip.paste()
+        if text != empty_clipboard:
+            clip_board = text
+            break
+        time.sleep(CLIPBOARD_POLL_INTERVAL)
+    # refill the clipboard with the original content, if there was any
+    if current_clipboard != empty_clipboard:
+        pyperclip.copy(current_clipboard)
+    return clip_board
+
+
+def load_json(path: str) -> Any:
+    """Parse a JSON file, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(Path(path).read_bytes())
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+@functools.lru_cache(maxsize=1)
+def load_config() -> dict:
+    """Load and cache the application settings."""
+    return load_json(CONFIG_PATH)
+
+
+def kokoro_voices_path() -> str:
+    """
+    The kokoro voices file from the "kokoro_voices" setting, voices.json by default.
+
+    Each kokoro_onnx release reads only one voices format, so the packed file is
+    only used when the setting asks for it.
+    """
+    return load_config().get("kokoro_voices", KOKORO_VOICES_JSON_PATH)
+
+
+def pack_kokoro_voices() -> None:
+    """Convert the kokoro voices JSON file into the packed voices.npz format."""
+    voices = load_json(KOKORO_VOICES_JSON_PATH)
+    np.savez(
+        KOKORO_VOICES_NPZ_PATH,
+        **{name: np.asarray(style, dtype=np.float32) for name, style in voices.items()},
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def load_voice_names() -> frozenset[str]:
+    """Load and cache the names of the kokoro voices."""
+    voices_path = kokoro_voices_path()
+    if voices_path.endswith(".npz"):
+        # Only reads the archive index, not the arrays
+        with np.load(voices_path) as voices:
+            return frozenset(voices.files)
+    return frozenset(load_json(voices_path))
 
 
 def check_inputs(
     speed_factor: float, speaker: str, tts_provider: str, sentence_pause: float
-) -> None:
-    if tts_provider not in ["piper", "kokoro"]:
-        raise ValueError("tts_provider must be either 'piper' or 'kokoro'")
-    logging.info(f"Using {tts_provider} TTS provider")
+) -> str:
+    """
+    Validate the settings.
+
+    Returns:
+        The speaker to use, resolved to an absolute model path for piper.
+    """
+    if tts_provider not in TTS_PROVIDERS:
+        raise ValueError(
+            f"tts_provider must be one of {', '.join(repr(p) for p in TTS_PROVIDERS)}"
+        )
+    logging.info("Using %s TTS provider", tts_provider)
 
     if tts_provider == "piper":
-        assert (Path.cwd() / speaker).exists(), f"Speaker file {speaker} does not exist"
+        speaker_path = Path.cwd() / speaker
+        try:
+            speaker = str(speaker_path.resolve(strict=True))
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Speaker file {speaker_path} does not exist")
 
     else:
-        assert (
-            speaker in json.load(open("voices.json")).keys()
-        ), f"Speaker {speaker} not found"
-        logging.info(
-            f'Other speakers available: {", ".join(json.load(open("voices.json")).keys())}'
-        )
+        voices = load_voice_names()
+        assert speaker in voices, f"Speaker {speaker} not found"
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Other speakers available: %s", ", ".join(sorted(voices)))
 
-    logging.info(f"Using speaker {speaker}")
+    logging.info("Using speaker %s", speaker)
 
     if sentence_pause < 0:
         raise ValueError("sentence_pause must be greater than or equal to 0")
 
-    logging.info(f"Using sentence pause {sentence_pause}")
+    logging.info("Using sentence pause %s", sentence_pause)
 
     if speed_factor <= 0:
         raise ValueError("speed_factor must be greater than 0")
     else:
-        logging.info(f"Using speed factor {speed_factor}")
+        logging.info("Using speed factor %s", speed_factor)
+
+    return speaker
+
+
+def primary_selection_command() -> Optional[list[str]]:
+    """Command that prints the PRIMARY selection on Linux, if one is available."""
+    if not sys.platform.startswith("linux"):
+        return None
+    if os.environ.get("WAYLAND_DISPLAY") and shutil.which("wl-paste"):
+        return ["wl-paste", "--primary", "--no-newline"]
+    if os.environ.get("DISPLAY") and shutil.which("xclip"):
+        return ["xclip", "-selection", "primary", "-o"]
+    return None
+
+
+PRIMARY_SELECTION_COMMAND = primary_selection_command()
+
+
+def read_primary_selection() -> Optional[str]:
+    """
+    Reads the currently selected text from the PRIMARY selection.
+
+    Returns:
+        The selected text, or None if it could not be read or is empty.
+    """
+    if PRIMARY_SELECTION_COMMAND is None:
+        return None
+    try:
+        result = subprocess.run(
+            PRIMARY_SELECTION_COMMAND,
+            capture_output=True,
+            encoding="utf-8",
+            # A selection that is not valid UTF-8 should still be read, not fail
+            errors="replace",
+            timeout=PRIMARY_SELECTION_TIMEOUT,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0 or not result.stdout.strip():
+        return None
+    return result.stdout
+
+
+def get_selected_text() -> str:
+    """
+    Gets the currently selected text, from the PRIMARY selection where the
+    platform has one, otherwise by copying it to the clipboard.
+
+    Returns:
+        The selected text.
+    """
+    selected_text = read_primary_selection()
+    if selected_text is None:
+        selected_text = copy_selected_text()
+    return selected_text
+
+
+def log_reading_error(reading: futures.Future) -> None:
+    """Report a reading that failed, since nothing else waits on its result."""
+    if not reading.cancelled() and reading.exception() is not None:
+        logging.error("Reading failed", exc_info=reading.exception())
 
 
 class AudioController:
@@ -80,6 +231,11 @@ class AudioController:
     Controller for managing the audio generation and playback.
     """
 
+    COPY_THEN_READ_KEY = 269025093
+    READ_FROM_CLIPBOARD_KEY = 269025094
+    # Virtual key code -> whether to read the clipboard instead of the selection
+    HOTKEYS = {COPY_THEN_READ_KEY: False, READ_FROM_CLIPBOARD_KEY: True}
+
     def __init__(
         self,
         speaker="en_en_US_joe_medium_en_US-joe-medium.onnx",
@@ -93,66 +249,92 @@ class AudioController:
         self.tts_provider = tts_provider
         self.engine = engine
         self.sentence_pause = sentence_pause
-        self.reading_thread = threading.Thread()
+        self.reading: Optional[futures.Future] = None
+        # One long-lived worker runs every reading, so no thread is created per press
+        self.reader = futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="reader"
+        )
         self.stop_audio_event = Event()
+        self.hotkey_presses: queue.Queue[bool] = queue.Queue()
+        self.dispatcher_thread = threading.Thread(
+            target=self.dispatch_hotkeys, daemon=True
+        )
+        self.dispatcher_thread.start()
 
     def start_stopper(self, key: Union[Key, KeyCode, None]) -> None:
         """
         Callback function for the keyboard listener to stop or start audio.
 
+        The listener blocks keyboard input while this runs, so the actual work
+        is handed to the dispatcher thread.
+
         Args:
             key: The key pressed, which can be of type Key, KeyCode, or None.
         """
-        key_code = getattr(key, "vk", None)
-        copy_then_read_key = 269025093
-        read_from_clipboard_key = 269025094
-        if key_code not in [copy_then_read_key, read_from_clipboard_key]:
-            return
-
-        from_clipboard = key_code == read_from_clipboard_key
+        from_clipboard = self.HOTKEYS.get(getattr(key, "vk", None))
+        if from_clipboard is not None:
+            self.hotkey_presses.put_nowait(from_clipboard)
+
+    def dispatch_hotkeys(self) -> None:
+        """Handle queued hotkey presses, one at a time, in the order they arrived."""
+        while True:
+            from_clipboard = self.hotkey_presses.get()
+            try:
+                self.toggle_reading(from_clipboard)
+            except Exception:
+                # Keep handling later presses, this thread is the only one that does
+                logging.exception("Hotkey handling failed")
+
+    def toggle_reading(self, from_clipboard: bool) -> None:
+        """
+        Stop the current reading if there is one, otherwise start a new one.
 
-        if self.reading_thread.is_alive():
+        Args:
+            from_clipboard: Read the clipboard instead of copying the selection.
+        """
+        if self.reading is not None and not self.reading.done():
             logging.info("Stopping audio")
             self.stop_audio_event.set()
-            self.reading_thread.join()
+            futures.wait([self.reading])
             self.stop_audio_event.clear()
 
         else:
             logging.info("Starting audio")
-            self.reading_thread = self.start_reading(
-                self.stop_audio_event, from_clipboard
-            )
+            self.reading = self.start_reading(self.stop_audio_event, from_clipboard)
 
     def start_reading(
         self, stop_audio_event: Event, from_clipboard: bool = False
-    ) -> threading.Thread:
+    ) -> Optional[futures.Future]:
         """
-        Starts a new thread for reading aloud the selected text.
+        Starts reading aloud the selected text on the reader worker.
 
         Args:
             stop_audio_event: An event to signal stopping the audio generation.
 
         Returns:
-            The thread that was started for reading.
+            The future of the reading, or None if there was nothing to read.
         """
         if from_clipboard:
             selected_text = pyperclip.paste()
         else:
-            selected_text = copy_selected_text()
-
-        reading_thread = threading.Thread(
-            target=async_audio_generation,
-            args=(
-                stop_audio_event,
-                selected_text,
-                self.speaker,
-                self.speed,
-                self.tts_provider,
-                self.engine,
-            ),
+            selected_text = get_selected_text()
+
+        if not selected_text.strip():
+            logging.info("Nothing to read")
+            return None
+
+        reading = self.reader.submit(
+            async_audio_generation,
+            stop_audio_event,
+            selected_text,
+            self.speaker,
+            self.speed,
+            self.tts_provider,
+            self.engine,
+            self.sentence_pause,
         )
-        reading_thread.start()
-        return reading_thread
+        reading.add_done_callback(log_reading_error)
+        return reading
 
 
 def setup_logging(show_info: bool):
@@ -173,6 +355,22 @@ def parse_arguments():
     """Parse command line arguments"""
     parser = argparse.ArgumentParser(description="Text-to-Speech Controller")
     parser.add_argument("--verbose", action="store_true", help="Show info logs")
+    parser.add_argument(
+        "--pack-voices",
+        action="store_true",
+        help=(
+            f"Convert {KOKORO_VOICES_JSON_PATH} to {KOKORO_VOICES_NPZ_PATH} and exit, "
+            f'set "kokoro_voices" to "{KOKORO_VOICES_NPZ_PATH}" in the config to use it'
+        ),
+    )
+    parser.add_argument(
+        "--quantize-voice",
+        action="store_true",
+        help=(
+            "Write an int8 copy of the configured piper voice, used from the next "
+            "start, and exit"
+        ),
+    )
     return parser.parse_args()
 
 
@@ -183,23 +381,43 @@ if __name__ == "__main__":
     setup_logging(args.verbose)
     logger = logging.getLogger(__name__)
 
+    if args.pack_voices:
+        pack_kokoro_voices()
+        print(
+            f'Wrote {KOKORO_VOICES_NPZ_PATH}, set "kokoro_voices" in {CONFIG_PATH} '
+            "to use it"
+        )
+        raise SystemExit(0)
+
     logger.info("Starting application")
 
     tqdm_setup_bar = tqdm(total=2, position=0, leave=True, desc="Loading config")
-    with open("config.json", "r") as file:
-        settings = json.load(file)
+    settings = load_config()
 
     speed = settings.get("speed", 1.0)
     speaker = settings.get("speaker", "en_en_US_joe_medium_en_US-joe-medium.onnx")
     tts_provider = settings.get("tts_provider", "piper")
     sentence_pause = settings.get("sentence_pause", 0.3)
+    disk_cache_mb = settings.get("disk_cache_mb", 500)
+    device = settings.get("device", "cpu")
+
+    speaker = check_inputs(speed, speaker, tts_provider, sentence_pause)
+
+    if args.quantize_voice:
+        tqdm_setup_bar.close()
+        if tts_provider != "piper":
+            raise ValueError("--quantize-voice only applies to the piper tts_provider")
+        print(f"Wrote {quantize_piper_voice(speaker)}")
+        raise SystemExit(0)
 
-    check_inputs(speed, speaker, tts_provider, sentence_pause)
+    audio_cache.max_disk_bytes = int(disk_cache_mb * 1024 * 1024)
 
     if tts_provider == "kokoro":
-        engine = Kokoro("kokoro-v0_19.onnx", "voices.json")
+        engine = Kokoro(KOKORO_MODEL_PATH, kokoro_voices_path())
     else:
-        engine = None
+        engine = load_piper_voice(speaker, device)
+    warm_up_engine(speaker, speed, tts_provider, engine)
+    warm_static_cache(speaker, speed, tts_provider, engine)
     tqdm_setup_bar.update(1)
     tqdm_setup_bar.set_description("Setting up audio controller")
 
@@ -217,4 +435,8 @@ if __name__ == "__main__":
     tqdm_setup_bar.close()
 
     with Listener(on_press=audio_controller.start_stopper) as listener:
-        listener.join()
+        try:
+            listener.join()
+        finally:
+            # Let an in-progress reading and its synthesis workers wind down
+            audio_controller.stop_audio_event.set()
@@ -1,21 +1,104 @@
+import functools
 import json
 import logging
+import os
+import pickle
 import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import emoji
-import inflect
-from nltk.tokenize import sent_tokenize
+import nltk.data
+
+
+def _load_sentence_tokenizer():
+    """Load the English Punkt tokenizer once instead of on every sent_tokenize call."""
+    try:
+        from nltk.tokenize import PunktTokenizer
+    except ImportError:  # nltk < 3.8.2 ships Punkt as a pickle
+        return nltk.data.load("tokenizers/punkt/english.pickle")
+    return PunktTokenizer("english")
+
+
+_SENTENCE_TOKENIZER = _load_sentence_tokenizer()
+
+# Words for spelling out numbers
+_ONES = tuple(
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen "
+    "fourteen fifteen sixteen seventeen eighteen nineteen".split()
+)
+_TENS = ("", "", *"twenty thirty forty fifty sixty seventy eighty ninety".split())
+_SCALES = (
+    "",
+    *"thousand million billion trillion quadrillion quintillion sextillion "
+    "septillion octillion nonillion decillion".split(),
+)
+
+# Runs of four or more digits that are not part of a word or a decimal, and
+# not amounts or signed numbers, which the engines already read correctly
+_LONG_NUMBER = re.compile(r"(?<![\w.,$€£¥₹¢+\-−])\d{4,}(?!\w|[.,]\d)")
+
+_NEWLINE_BEFORE_CAPITAL = re.compile(r"\n(?=[A-Z])")
+
+# Tokenizer output that carries nothing worth speaking
+_JUNK_SENTENCES = frozenset({"."})
+
+# Sentence-ending punctuation followed by more text
+_SENTENCE_BOUNDARY = re.compile(r"[.!?]\S*\s+\S")
+
+
+def _tens_to_words(number: int) -> str:
+    if number < 20:
+        return _ONES[number]
+    tens, units = divmod(number, 10)
+    return f"{_TENS[tens]}-{_ONES[units]}" if units else _TENS[tens]
+
+
+def _hundreds_to_words(number: int) -> str:
+    hundreds, rest = divmod(number, 100)
+    if not hundreds:
+        return _tens_to_words(rest)
+    if not rest:
+        return f"{_ONES[hundreds]} hundred"
+    return f"{_ONES[hundreds]} hundred and {_tens_to_words(rest)}"
+
+
+@functools.lru_cache(maxsize=4096)
+def _number_to_words(digits: str) -> str:
+    """
+    Spell out a string of digits as an English cardinal number, the same way
+    inflect's number_to_words does, e.g. "one thousand, two hundred and
+    thirty-four". Numbers too large to name are read digit by digit.
+    """
+    number = int(digits)
+    if not number:
+        return _ONES[0]
+
+    groups = []
+    while number:
+        number, group = divmod(number, 1000)
+        groups.append(group)
+    if len(groups) > len(_SCALES):
+        return " ".join(_ONES[int(digit)] for digit in digits)
+
+    words = [
+        f"{_hundreds_to_words(group)} {_SCALES[i]}" if i else _hundreds_to_words(group)
+        for i, group in reversed(list(enumerate(groups)))
+        if group
+    ]
+    if len(words) > 1 and 0 < groups[0] < 100:
+        # "two thousand and twenty-four" rather than "two thousand, twenty-four"
+        return f"{', '.join(words[:-1])} and {words[-1]}"
+    return ", ".join(words)
 
 
 def replace_long_numbers(text: str) -> str:
-    p = inflect.engine()
-    words = text.split()
-    for i, word in enumerate(words):
-        if word.isdigit() and len(word) > 3:
-            words[i] = p.number_to_words(word)  # type: ignore
-    return " ".join(words)
+    if not _LONG_NUMBER.search(text):
+        # Most text has no long numbers, skip building the substitution
+        return text
+    return _LONG_NUMBER.sub(lambda match: _number_to_words(match.group()), text)
 
 
 def load_replacement_rules(config_path: Union[str, Path]) -> List[List[str]]:
@@ -56,60 +139,312 @@ def load_replacement_rules(config_path: Union[str, Path]) -> List[List[str]]:
         )
 
 
-def clean_text(
-    text: str, config_path: Union[str, Path] = "text_replacements.json"
-) -> str:
+@dataclass(frozen=True)
+class CompiledRules:
+    """Replacement rules as ordered str.translate tables and replacement pairs."""
+
+    steps: Tuple[Union[Dict[int, str], Tuple[str, str]], ...] = ()
+
+
+# Suffixes of files written by precompile_rules
+PICKLED_RULES_SUFFIXES = (".pickle", ".pkl")
+
+
+def compile_replacement_rules(rules: List[List[str]]) -> CompiledRules:
     """
-    Clean text by removing unwanted characters and standardizing formatting.
+    Turn replacement rules into steps that give the same result as applying
+    the rules one by one with str.replace.
+
+    Consecutive single-character rules are merged into one str.translate table
+    as long as no rule's output feeds a later rule in the same table; every
+    other rule stays an ordered (from_text, to_text) replacement.
 
     Args:
-        text: Input text to clean
-        config_path: Path to the JSON configuration file containing replacement rules
+        rules: Replacement rules, each containing [from_text, to_text]
 
     Returns:
-        Cleaned text string
+        Compiled rules for apply_replacement_rules
+    """
+    steps: List[Union[Dict[int, str], Tuple[str, str]]] = []
+    table: Dict[int, str] = {}
+    produced = ""
+    for from_text, to_text in rules:
+        if len(from_text) == 1:
+            if ord(from_text) in table or from_text in produced:
+                steps.append(table)
+                table, produced = {}, ""
+            table[ord(from_text)] = to_text
+            produced += to_text
+            continue
+        if table:
+            steps.append(table)
+            table, produced = {}, ""
+        steps.append((from_text, to_text))
+    if table:
+        steps.append(table)
+    return CompiledRules(tuple(steps))
+
+
+def apply_replacement_rules(text: str, rules: CompiledRules) -> str:
+    """Apply rules produced by compile_replacement_rules to text."""
+    for step in rules.steps:
+        if isinstance(step, dict):
+            text = text.translate(step)
+        else:
+            text = text.replace(*step)
+    return text
+
+
+def precompile_rules(json_path: Union[str, Path], out_path: Union[str, Path]) -> None:
+    """
+    Compile the replacement rules in a JSON file and pickle them, so they can
+    be loaded at startup without parsing and compiling the JSON again.
+
+    Args:
+        json_path: Path to the JSON configuration file
+        out_path: Path of the pickle file to write, ending in .pickle or .pkl
+    """
+    compiled = compile_replacement_rules(load_replacement_rules(json_path))
+    with open(out_path, "wb") as f:
+        pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_compiled_rules(config_path: Union[str, Path]) -> CompiledRules:
+    if Path(config_path).suffix in PICKLED_RULES_SUFFIXES:
+        with open(config_path, "rb") as f:
+            try:
+                compiled = pickle.load(f)
+            except Exception as e:
+                # Truncated files and pickles of an older layout fail in many ways
+                raise pickle.UnpicklingError(f"Cannot load {config_path}: {e}") from e
+        if not isinstance(compiled, CompiledRules) or not isinstance(
+            getattr(compiled, "steps", None), tuple
+        ):
+            raise pickle.UnpicklingError(f"{config_path} does not hold CompiledRules")
+        return compiled
+    return compile_replacement_rules(load_replacement_rules(config_path))
+
+
+@functools.lru_cache(maxsize=8)
+def _load_compiled_rules_cached(config_path: str, mtime_ns: int) -> CompiledRules:
+    return _read_compiled_rules(config_path)
+
+
+def load_compiled_rules(
+    config_path: Union[str, Path, CompiledRules],
+) -> CompiledRules:
+    """
+    Load and compile replacement rules, reusing the result until the file changes.
+
+    Args:
+        config_path: Path to the JSON configuration file, a file written by
+            precompile_rules, or already compiled rules
+
+    Returns:
+        Compiled rules for apply_replacement_rules
     """
+    if isinstance(config_path, CompiledRules):
+        return config_path
+    try:
+        mtime_ns = os.stat(config_path).st_mtime_ns
+    except OSError:
+        # Let the loaders report the problem
+        return _read_compiled_rules(config_path)
+    return _load_compiled_rules_cached(str(config_path), mtime_ns)
+
+
+def _clean_text(text: str, rules: CompiledRules) -> str:
     # Replace newlines with periods if they're followed by capital letters
-    text = re.sub(r"\n(?=[A-Z])", ". ", text)
+    text = _NEWLINE_BEFORE_CAPITAL.sub(". ", text)
 
     # Normalize whitespace
     text = " ".join(text.split())
 
-    try:
-        # Load and apply replacement rules
-        remove_chars = load_replacement_rules(config_path)
-        for char in remove_chars:
-            text = text.replace(char[0], char[1])
+    # Apply replacement rules
+    return apply_replacement_rules(text, rules)
 
-        return text
 
-    except (FileNotFoundError, json.JSONDecodeError, KeyError) as e:
+def _load_rules_or_warn(
+    config_path: Union[str, Path, CompiledRules],
+) -> CompiledRules:
+    try:
+        return load_compiled_rules(config_path)
+    except (
+        FileNotFoundError,
+        json.JSONDecodeError,
+        KeyError,
+        pickle.UnpicklingError,
+    ) as e:
         logging.warning(f"Warning: Error loading replacement rules - {str(e)}")
+        return CompiledRules()
 
-        return text
+
+def clean_text(
+    text: str, config_path: Union[str, Path, CompiledRules] = "text_replacements.json"
+) -> str:
+    """
+    Clean text by removing unwanted characters and standardizing formatting.
+
+    Args:
+        text: Input text to clean
+        config_path: Path to the JSON configuration file containing replacement rules,
+            a file written by precompile_rules, or already compiled rules
+
+    Returns:
+        Cleaned text string
+    """
+    return _clean_text(text, _load_rules_or_warn(config_path))
+
+
+def iter_sentences(text: str) -> Iterator[str]:
+    """Yield the sentences of text one at a time, skipping empty and junk chunks."""
+    if not _SENTENCE_BOUNDARY.search(text):
+        # At most one sentence, no need to run the tokenizer
+        text_chunks: Iterable[str] = (text,)
+    else:
+        # span_tokenize finds boundaries lazily, unlike tokenize which builds a list
+        text_chunks = (
+            text[start:end] for start, end in _SENTENCE_TOKENIZER.span_tokenize(text)
+        )
+
+    for chunk in text_chunks:
+        chunk = chunk.strip()
+        if chunk and chunk not in _JUNK_SENTENCES:
+            yield chunk
 
 
 def make_sentences(text: str) -> list[str]:
+    return list(iter_sentences(text))
+
+
+def combine_short_sentences(text_chunks: list[str], min_words: int = 4) -> list[str]:
+    """
+    Merge sentences shorter than min_words into the following sentence, or the
+    previous one at the end of the text, so each synthesis call has enough
+    text to be worth its fixed overhead.
+
+    Args:
+        text_chunks: Sentences in reading order
+        min_words: Minimum number of words per combined chunk
+
+    Returns:
+        Combined sentences
+    """
+    combined: list[str] = []
+    pending: list[str] = []
+    pending_words = 0
+    for chunk in text_chunks:
+        pending.append(chunk)
+        pending_words += len(chunk.split())
+        if pending_words >= min_words:
+            combined.append(" ".join(pending))
+            pending = []
+            pending_words = 0
 
-    text_chunks = sent_tokenize(text)
-    for rm in ["\r", "\t", ".", " "]:
-        if rm in text_chunks:
-            text_chunks.remove(rm)
+    if pending:
+        if combined:
+            combined[-1] = " ".join([combined[-1], *pending])
+        else:
+            combined.append(" ".join(pending))
 
-    text_chunks = [chunk.strip() for chunk in text_chunks]
+    return combined
 
-    return text_chunks
+
+def group_sentences(
+    text_chunks: list[str], max_chars: int = 200, max_words: Optional[int] = None
+) -> list[str]:
+    """
+    Join adjacent sentences into chunks of at most max_chars characters, and
+    at most max_words words if given, so they can be synthesized in a single
+    call. Longer sentences are kept whole.
+
+    Args:
+        text_chunks: Sentences in reading order
+        max_chars: Maximum length of a joined chunk
+        max_words: Maximum number of words in a joined chunk
+
+    Returns:
+        Grouped sentences
+    """
+    grouped: list[str] = []
+    grouped_words: list[int] = []
+    for chunk in text_chunks:
+        words = len(chunk.split())
+        if (
+            grouped
+            and len(grouped[-1]) + 1 + len(chunk) <= max_chars
+            and (max_words is None or grouped_words[-1] + words <= max_words)
+        ):
+            grouped[-1] = f"{grouped[-1]} {chunk}"
+            grouped_words[-1] += words
+        else:
+            grouped.append(chunk)
+            grouped_words.append(words)
+
+    return grouped
+
+
+def combined_text_cleaning_batch(
+    texts: List[str],
+    config_path: Union[str, Path, CompiledRules] = "text_replacements.json",
+) -> List[str]:
+    """
+    Apply combined_text_cleaning to many texts, loading the replacement rules
+    only once for the whole batch.
+
+    Args:
+        texts: Input texts to clean
+        config_path: Path to the JSON configuration file containing replacement rules,
+            a file written by precompile_rules, or already compiled rules
+
+    Returns:
+        Cleaned texts, in the same order
+    """
+    rules = _load_rules_or_warn(config_path)
+
+    cleaned = []
+    for text in texts:
+        # Remove unwanted characters
+        text = _clean_text(text, rules)
+
+        # Replace long numbers with words
+        text = replace_long_numbers(text)
+
+        # Replace emojis with text, ASCII-only text cannot contain any
+        if not text.isascii():
+            text = emoji.demojize(text)
+
+        cleaned.append(text)
+
+    return cleaned
 
 
-def combined_text_cleaning(text: str) -> str:
+def combined_text_cleaning(
+    text: str, config_path: Union[str, Path, CompiledRules] = "text_replacements.json"
+) -> str:
     """Remove unwanted characters, replace long numbers with words, and replace emojis with text."""
-    # Remove unwanted characters
-    text = clean_text(text)
+    return combined_text_cleaning_batch([text], config_path)[0]
 
-    # Replace long numbers with words
-    text = replace_long_numbers(text)
 
-    # Replace emojis with text
-    text = emoji.demojize(text)
+def combined_text_cleaning_parallel(
+    texts: List[str],
+    config_path: Union[str, Path, CompiledRules] = "text_replacements.json",
+    n_workers: Optional[int] = None,
+    chunksize: int = 64,
+) -> List[str]:
+    """
+    Apply combined_text_cleaning to many texts using a pool of processes.
 
-    return text
+    Args:
+        texts: Input texts to clean
+        config_path: Path to the JSON configuration file containing replacement rules,
+            a file written by precompile_rules, or already compiled rules
+        n_workers: Number of worker processes, defaults to the number of CPUs
+        chunksize: Number of texts sent to a worker at a time
+
+    Returns:
+        Cleaned texts, in the same order
+    """
+    clean = functools.partial(combined_text_cleaning, config_path=config_path)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(clean, texts, chunksize=chunksize))